@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+"""Keeps the resources of a kubernetes-deployer unit in their desired state.
+
+All resource files of the unit are applied
+ - whenever the desired state of a watched, deployer labeled resource
+   changes on the cluster, e.g. when someone deletes a managed Service or
+   edits the spec of a Deployment. Status updates are ignored, and so are
+   replica counts since autoscalers own those,
+ - whenever the daemon receives SIGHUP, which the charm sends after it
+   changed the resource files,
+ - and at least every `interval` seconds.
+Workloads with a HorizontalPodAutoscaler are applied with the replica
+count the autoscaler set, so applies do not scale them back.
+The result of the last apply is written to the state file so the charm can
+report it.
+"""
+import os
+import json
+import time
+import hashlib
+import select
+import signal
+import argparse
+import threading
+from subprocess import run, Popen, PIPE, DEVNULL
+
+import yaml
+
+
+# Events come in bursts (e.g. during a rollout), wait for them to settle
+SETTLE_TIME = 2
+MIN_APPLY_INTERVAL = 5
+WATCH_RESTART_DELAY = 10
+
+
+def desired_state(resource):
+    """Return a fingerprint of the part of a resource the deployer manages."""
+    resource = {key: value for key, value in resource.items() if key not in ('metadata', 'status')}
+    if isinstance(resource.get('spec'), dict):
+        resource['spec'] = {key: value for key, value in resource['spec'].items() if key != 'replicas'}
+    return hashlib.md5(json.dumps(resource, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def json_stream(lines):
+    """Yield the JSON documents kubectl writes one after the other."""
+    decoder = json.JSONDecoder()
+    buffer = ''
+    for line in lines:
+        buffer += line.decode('utf-8', 'replace')
+        try:
+            document, end = decoder.raw_decode(buffer.lstrip())
+        except ValueError:
+            continue
+        buffer = buffer.lstrip()[end:]
+        yield document
+
+
+class Reconciler(object):
+    def __init__(self, args):
+        self.args = args
+        # Watch threads and SIGHUP (through the wakeup fd) wake the main loop via
+        # this pipe, a signal handler must not take the lock of a threading.Event
+        self.wakeup_read, self.wakeup_write = os.pipe()
+        os.set_blocking(self.wakeup_read, False)
+        os.set_blocking(self.wakeup_write, False)
+
+    def trigger(self):
+        """Request a reconcile."""
+        try:
+            os.write(self.wakeup_write, b'\0')
+        except BlockingIOError:
+            # The pipe is full, a reconcile is pending already
+            pass
+
+    def wait(self, timeout):
+        """Wait at most timeout seconds for a reconcile request."""
+        select.select([self.wakeup_read], [], [], timeout)
+
+    def clear(self):
+        try:
+            while os.read(self.wakeup_read, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def kubectl_get(self, resource_type, *args):
+        return ['kubectl', 'get', resource_type,
+                '--namespace', self.args.namespace,
+                '--selector', self.args.selector,
+                '-o', 'json'] + list(args)
+
+    def watch(self, resource_type):
+        """Trigger a reconcile when a resource of the given type is deleted
+        or its desired state changes."""
+        while True:
+            states = {}
+            listing = run(self.kubectl_get(resource_type), stdout=PIPE, stderr=DEVNULL)
+            if listing.returncode == 0:
+                for resource in json.loads(listing.stdout.decode('utf-8')).get('items', []):
+                    states[resource['metadata']['uid']] = desired_state(resource)
+            proc = Popen(self.kubectl_get(resource_type, '--watch-only', '--output-watch-events'),
+                         stdout=PIPE, stderr=DEVNULL)
+            for event in json_stream(proc.stdout):
+                resource = event.get('object') or {}
+                uid = resource.get('metadata', {}).get('uid')
+                if event.get('type') == 'DELETED':
+                    states.pop(uid, None)
+                    self.trigger()
+                    continue
+                state = desired_state(resource)
+                if event.get('type') == 'MODIFIED' and states.get(uid) != state:
+                    self.trigger()
+                states[uid] = state
+            proc.wait()
+            # The API server closes watches after a while, restart it
+            time.sleep(WATCH_RESTART_DELAY)
+
+    def live_replicas(self, kind, name):
+        result = run(['kubectl', 'get', kind, name,
+                      '--namespace', self.args.namespace,
+                      '-o', 'jsonpath={.spec.replicas}'], stdout=PIPE, stderr=DEVNULL)
+        replicas = result.stdout.decode('utf-8').strip()
+        return int(replicas) if result.returncode == 0 and replicas.isdigit() else None
+
+    def refresh_replicas(self, path):
+        """Set the live replica count of autoscaled workloads in a resource file."""
+        with open(path) as f:
+            content = f.read()
+        # The deployer writes autoscalers to the file of their workload
+        if 'HorizontalPodAutoscaler' not in content:
+            return
+        documents = list(yaml.safe_load_all(content))
+        targets = set()
+        for document in documents:
+            if document and document.get('kind') == 'HorizontalPodAutoscaler':
+                target = document['spec']['scaleTargetRef']
+                targets.add((target['kind'], target['name']))
+        changed = False
+        for document in documents:
+            if not document or (document.get('kind'), document['metadata'].get('name')) not in targets:
+                continue
+            replicas = self.live_replicas(document['kind'], document['metadata']['name'])
+            if replicas is not None and replicas != document['spec'].get('replicas'):
+                document['spec']['replicas'] = replicas
+                changed = True
+        if changed:
+            # kubectl only applies .yaml, .yml and .json files
+            tmp_file = path + '.tmp'
+            with open(tmp_file, 'w') as f:
+                yaml.dump_all(documents, f)
+            os.rename(tmp_file, path)
+
+    def apply(self):
+        for root, _, files in os.walk(self.args.path):
+            for file in files:
+                if file.endswith('.yaml'):
+                    try:
+                        self.refresh_replicas(os.path.join(root, file))
+                    except (OSError, yaml.YAMLError, KeyError, TypeError, AttributeError):
+                        # The charm is rewriting the file, the next apply uses the new one
+                        continue
+        result = run(['kubectl', 'apply', '-R', '-f', self.args.path], stdout=PIPE, stderr=PIPE)
+        state = {
+            'time': time.time(),
+            'ok': result.returncode == 0,
+            'error': result.stderr.decode('utf-8', 'replace').strip(),
+        }
+        tmp_file = self.args.state_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(state, f)
+        os.rename(tmp_file, self.args.state_file)
+
+    def run(self):
+        # The wakeup fd does the work, the handler only keeps SIGHUP from ending the process
+        signal.signal(signal.SIGHUP, lambda signum, frame: None)
+        signal.set_wakeup_fd(self.wakeup_write)
+        for resource_type in self.args.types.split(','):
+            threading.Thread(target=self.watch, args=(resource_type,), daemon=True).start()
+        while True:
+            self.wait(self.args.interval)
+            time.sleep(SETTLE_TIME)
+            self.clear()
+            if os.path.isdir(self.args.path):
+                self.apply()
+            time.sleep(MIN_APPLY_INTERVAL)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--path', required=True, help='dir with the resource files')
+    parser.add_argument('--namespace', required=True)
+    parser.add_argument('--selector', required=True, help='label selector of the managed resources')
+    parser.add_argument('--types', required=True, help='comma separated resource types to watch')
+    parser.add_argument('--interval', type=int, default=30, help='max seconds between applies')
+    parser.add_argument('--state-file', required=True)
+    Reconciler(parser.parse_args()).run()
+
+
+if __name__ == '__main__':
+    main()
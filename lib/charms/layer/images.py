@@ -0,0 +1,84 @@
+import re
+import json
+from urllib.parse import urlencode
+from urllib.request import Request, urlopen
+from urllib.error import HTTPError, URLError
+
+
+DEFAULT_REGISTRY = 'registry-1.docker.io'
+DOCKER_HUB_ALIASES = ['docker.io', 'index.docker.io', DEFAULT_REGISTRY]
+MANIFEST_TYPES = [
+    'application/vnd.docker.distribution.manifest.list.v2+json',
+    'application/vnd.docker.distribution.manifest.v2+json',
+    'application/vnd.oci.image.index.v1+json',
+    'application/vnd.oci.image.manifest.v1+json',
+]
+REGISTRY_TIMEOUT = 10
+
+
+def parse_image(image):
+    """Split an image reference.
+
+    Args:
+        image (str): e.g. 'nginx:1.15', 'quay.io/org/app@sha256:...'
+    Returns:
+        (registry, repository, tag, digest), tag and digest can be None
+    """
+    name, _, digest = image.partition('@')
+    registry = DEFAULT_REGISTRY
+    first, sep, rest = name.partition('/')
+    if sep and ('.' in first or ':' in first or first == 'localhost'):
+        registry, name = first, rest
+    if registry in DOCKER_HUB_ALIASES:
+        registry = DEFAULT_REGISTRY
+        if '/' not in name:
+            name = 'library/' + name
+    tag = None
+    if ':' in name.rsplit('/', 1)[-1]:
+        name, tag = name.rsplit(':', 1)
+    return registry, name, tag, digest or None
+
+
+def resolve_digest(image):
+    """Return the digest the tag of an image currently points to.
+    Only anonymous registry access is supported.
+
+    Args:
+        image (str): image reference
+    Returns:
+        digest (str) or None if it could not be resolved
+    """
+    registry, repository, tag, digest = parse_image(image)
+    if digest:
+        return digest
+    url = 'https://{}/v2/{}/manifests/{}'.format(registry, repository, tag or 'latest')
+    headers = {'Accept': ', '.join(MANIFEST_TYPES)}
+    try:
+        try:
+            return _manifest_digest(url, headers)
+        except HTTPError as e:
+            token = _registry_token(e.headers.get('WWW-Authenticate', '')) if e.code == 401 else None
+            if not token:
+                return None
+            headers['Authorization'] = 'Bearer ' + token
+            return _manifest_digest(url, headers)
+    except (URLError, OSError, ValueError):
+        return None
+
+
+def _manifest_digest(url, headers):
+    with urlopen(Request(url, headers=headers, method='HEAD'), timeout=REGISTRY_TIMEOUT) as response:
+        return response.headers.get('Docker-Content-Digest')
+
+
+def _registry_token(challenge):
+    """Return an anonymous bearer token for a `WWW-Authenticate: Bearer ...` challenge."""
+    if not challenge.lower().startswith('bearer '):
+        return None
+    params = dict(re.findall(r'(\w+)="([^"]*)"', challenge))
+    realm = params.pop('realm', None)
+    if not realm:
+        return None
+    with urlopen(realm + '?' + urlencode(params), timeout=REGISTRY_TIMEOUT) as response:
+        body = json.loads(response.read().decode('utf-8'))
+    return body.get('token') or body.get('access_token')
@@ -1,20 +1,147 @@
 import os
+import re
+import sys
 import json
+import time
 import random
-from subprocess import call, check_output, check_call, CalledProcessError
+from subprocess import run, CalledProcessError, PIPE
 from charmhelpers.core.hookenv import log
 
 
+'''
+RATE LIMITING
+'''
+
+# Every kubectl call made during a hook goes through one token bucket.
+# Writes (apply, create, delete, label) may drain the bucket completely,
+# reads have to leave READ_RESERVE tokens so they never starve a write.
+API_QPS = 5.0
+API_BURST = 10
+READ_RESERVE = 3
+# Total number of seconds a single hook may spend waiting on retries.
+RETRY_BUDGET = 120
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 30
+
+PRIORITY_HIGH = 'high'
+PRIORITY_LOW = 'low'
+
+# Match the reasons kubectl prints, not bare status codes which also occur in resource names
+THROTTLED_ERRORS = re.compile(r'\(TooManyRequests\)|\(ServiceUnavailable\)|too many requests|'
+                              r'currently unable to handle the request', re.IGNORECASE)
+TRANSIENT_ERRORS = re.compile(r'connection refused|connection reset|i/o timeout|tls handshake timeout|'
+                              r'request timed out|unexpected eof|the object has been modified', re.IGNORECASE)
+RETRY_AFTER = re.compile(r'retry-after:?\s*(\d+)|try again (?:in|after) (\d+)', re.IGNORECASE)
+NOT_FOUND_ERRORS = re.compile(r'\(NotFound\)|not found', re.IGNORECASE)
+
+
+class TokenBucket(object):
+    def __init__(self, rate, burst, reserve=0):
+        self.rate = rate
+        self.burst = burst
+        self.reserve = reserve
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, priority=PRIORITY_LOW):
+        """Block until a token is available for a call with the given priority."""
+        needed = 1 if priority == PRIORITY_HIGH else 1 + self.reserve
+        while True:
+            self._refill()
+            if self.tokens >= needed:
+                self.tokens -= 1
+                return
+            time.sleep((needed - self.tokens) / self.rate)
+
+
+_limiter = TokenBucket(API_QPS, API_BURST, READ_RESERVE)
+# Set by the first retry, all retries of a hook share one budget.
+_retry_deadline = None
+
+
+def _retry_delay(stderr, attempt, idempotent=True):
+    """Return the number of seconds to wait before retrying a failed call,
+    or None if the failure is not worth retrying.
+    """
+    if NOT_FOUND_ERRORS.search(stderr):
+        return None
+    if THROTTLED_ERRORS.search(stderr):
+        retry_after = RETRY_AFTER.search(stderr)
+        if retry_after:
+            return int(retry_after.group(1) or retry_after.group(2)) + random.uniform(0, 1)
+    # A transient error can hide a request the API server did process,
+    # only calls that can safely be repeated are retried.
+    elif not idempotent or not TRANSIENT_ERRORS.search(stderr):
+        return None
+    # Exponential backoff with full jitter
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+
+def _kubectl(cmd, priority, capture):
+    global _retry_deadline
+    idempotent = 'create' not in cmd
+    attempt = 0
+    while True:
+        _limiter.acquire(priority)
+        result = run(cmd, stdout=PIPE if capture else None, stderr=PIPE)
+        stderr = result.stderr.decode('utf-8', 'replace')
+        if result.returncode == 0:
+            sys.stderr.write(stderr)
+            return result
+        if attempt and 'delete' in cmd and NOT_FOUND_ERRORS.search(stderr):
+            # An earlier attempt deleted the object before failing.
+            sys.stderr.write(stderr)
+            result.returncode = 0
+            return result
+        delay = _retry_delay(stderr, attempt, idempotent)
+        if _retry_deadline is None:
+            _retry_deadline = time.monotonic() + RETRY_BUDGET
+        if delay is None or time.monotonic() + delay > _retry_deadline:
+            sys.stderr.write(stderr)
+            return result
+        log('kubectl call failed ({}), retrying in {:.1f}s'.format(stderr.strip(), delay))
+        time.sleep(delay)
+        attempt += 1
+
+
+def _check_call(cmd, priority=PRIORITY_LOW):
+    """Rate limited and retried equivalent of subprocess.check_call."""
+    result = _kubectl(cmd, priority, capture=False)
+    if result.returncode:
+        raise CalledProcessError(result.returncode, cmd, stderr=result.stderr)
+
+
+def _check_output(cmd, priority=PRIORITY_LOW):
+    """Rate limited and retried equivalent of subprocess.check_output."""
+    result = _kubectl(cmd, priority, capture=True)
+    if result.returncode:
+        raise CalledProcessError(result.returncode, cmd, output=result.stdout, stderr=result.stderr)
+    return result.stdout
+
+
+def _call(cmd, priority=PRIORITY_LOW):
+    """Rate limited and retried equivalent of subprocess.call."""
+    return _kubectl(cmd, priority, capture=False).returncode
+
+
 '''
 GENERAL HELPER METHODS
 '''
 
+# Resource types the deployer creates for requesting apps
+MANAGED_RESOURCE_TYPES = ['all', 'cm', 'secrets', 'resourcequotas', 'priorityclasses', 'poddisruptionbudgets']
+
 
 def create_resources(path):
     """Create Kubernetes resources based on generated config files.
     """
     try:
-        check_call(['kubectl', 'apply', '-R', '-f', path])
+        _check_call(['kubectl', 'apply', '-R', '-f', path], PRIORITY_HIGH)
     except CalledProcessError as e:
         log('Could not create, modify resources')
         log(e)
@@ -22,6 +149,27 @@ def create_resources(path):
     return True
 
 
+def dry_run_resources(path):
+    """Run a single server-side dry run of `kubectl apply` for all
+    resources in path.
+
+    Args:
+        path (str): path to a dir with config yamls
+    Returns:
+        ([(resource, action), ...], error output or None)
+        where resource is `type/name` and action one of
+        created, configured or unchanged.
+    """
+    result = _kubectl(['kubectl', 'apply', '--dry-run=server', '-R', '-f', path], PRIORITY_LOW, capture=True)
+    changes = []
+    for line in result.stdout.decode('utf-8').splitlines():
+        match = re.match(r'^(\S+/\S+) (created|configured|unchanged)', line)
+        if match:
+            changes.append((match.group(1), match.group(2)))
+    error = result.stderr.decode('utf-8').strip() if result.returncode else None
+    return changes, error
+
+
 def create_resource_by_file(path):
     """Create a resource via file.
 
@@ -31,7 +179,7 @@ def create_resource_by_file(path):
         json output of kubectl create on success, False on failure.
     """
     try:
-        resource = check_output(['kubectl', 'create', '-f', path, '-o', 'json']).decode('utf-8')
+        resource = _check_output(['kubectl', 'create', '-f', path, '-o', 'json'], PRIORITY_HIGH).decode('utf-8')
         return json.loads(resource)
     except CalledProcessError:
         return False
@@ -47,7 +195,7 @@ def resource_exists_by_file(path):
         True | False
     """
     try:
-        check_call(['kubectl', 'get', '-f', path])
+        _check_call(['kubectl', 'get', '-f', path])
     except CalledProcessError:
         return False
     return True
@@ -63,12 +211,36 @@ def get_resource_by_file(path):
         dict or None if not found
     """
     try:
-        resource = check_output(['kubectl', 'get', '-f', path, '-o', 'json']).decode('utf-8')
+        resource = _check_output(['kubectl', 'get', '-f', path, '-o', 'json']).decode('utf-8')
         return json.loads(resource)
     except CalledProcessError:
         return None
 
 
+def get_resources_by_label(namespace, resources, label):
+    """Return all resources of the given types matching a label selector.
+
+    Args:
+        namespace (str): namespace to search in
+        resources (list): resource types
+        label (str): label selector
+    Returns:
+        list of resources (dict)
+    """
+    try:
+        output = _check_output(['kubectl',
+                                'get',
+                                ','.join(resources),
+                                '--namespace',
+                                namespace,
+                                '--selector=' + label,
+                                '-o',
+                                'json']).decode('utf-8')
+        return json.loads(output)['items']
+    except CalledProcessError:
+        return []
+
+
 def get_resource_by_name_type(name, namespace, type):
     """
     Return detailed info about a resource.
@@ -81,14 +253,14 @@ def get_resource_by_name_type(name, namespace, type):
         resource (dict) or None if not found
     """
     try:
-        resource = check_output(['kubectl',
-                                 'get',
-                                 type,
-                                 name,
-                                 '-n',
-                                 namespace,
-                                 '-o',
-                                 'json']).decode('utf-8')
+        resource = _check_output(['kubectl',
+                                  'get',
+                                  type,
+                                  name,
+                                  '-n',
+                                  namespace,
+                                  '-o',
+                                  'json']).decode('utf-8')
         return json.loads(resource)
     except CalledProcessError:
         return None
@@ -96,34 +268,34 @@ def get_resource_by_name_type(name, namespace, type):
 
 def delete_resources_by_label(namespace, resources, label):  # resources is type list !
     try:
-        check_call(['kubectl',
-                    'delete',
-                    ','.join(resources),
-                    '--namespace',
-                    namespace,
-                    '--selector=' + label])
+        _check_call(['kubectl',
+                     'delete',
+                     ','.join(resources),
+                     '--namespace',
+                     namespace,
+                     '--selector=' + label], PRIORITY_HIGH)
     except CalledProcessError as e:
         log(e)
 
 
 def delete_resource_by_name(namespace, resource, name):
     try:
-        check_call(['kubectl',
-                    'delete',
-                    resource,
-                    '--namespace',
-                    namespace,
-                    name])
+        _check_call(['kubectl',
+                     'delete',
+                     resource,
+                     '--namespace',
+                     namespace,
+                     name], PRIORITY_HIGH)
     except CalledProcessError as e:
         log(e)
 
 
 def delete_resource_by_file(path):
     try:
-        check_call(['kubectl',
-                    'delete',
-                    '-f',
-                    path])
+        _check_call(['kubectl',
+                     'delete',
+                     '-f',
+                     path], PRIORITY_HIGH)
     except CalledProcessError as e:
         log(e)
 
@@ -134,12 +306,12 @@ def get_worker_node_ips():
     Returns:
         list
     """
-    ips = check_output(['kubectl',
-                        'get',
-                        'nodes',
-                        '-o',
-                        'jsonpath=\'{.items[*].status.addresses[?(@.type==\"InternalIP\")].address}\'',
-                        ]).decode('utf-8')
+    ips = _check_output(['kubectl',
+                         'get',
+                         'nodes',
+                         '-o',
+                         'jsonpath=\'{.items[*].status.addresses[?(@.type==\"InternalIP\")].address}\'',
+                         ]).decode('utf-8')
     ips = ips.replace("'", "")
     return ips.split(' ')
 
@@ -151,12 +323,12 @@ def get_random_node_ip():
     Returns:
         str
     """
-    nodes = check_output(['kubectl',
-                          'get',
-                          'nodes',
-                          '-o',
-                          'jsonpath="{.items[0].status.addresses[*].address}"'
-                          ]).decode('utf-8')
+    nodes = _check_output(['kubectl',
+                           'get',
+                           'nodes',
+                           '-o',
+                           'jsonpath="{.items[0].status.addresses[*].address}"'
+                           ]).decode('utf-8')
     nodes = nodes.replace('"', '')
     return random.choice(nodes.split(' '))
 
@@ -179,13 +351,13 @@ def get_running_containers(unit, namespace):
     """
     config = {'host': get_random_node_ip()}
     try:
-        service_info = check_output(['kubectl',
-                                     '--namespace', namespace,
-                                     'get',
-                                     'service',
-                                     unit,
-                                     '-o',
-                                     'json']).decode('utf-8')
+        service_info = _check_output(['kubectl',
+                                      '--namespace', namespace,
+                                      'get',
+                                      'service',
+                                      unit,
+                                      '-o',
+                                      'json']).decode('utf-8')
         service = json.loads(service_info)
         ports = {}
         for port in service['spec']['ports']:
@@ -215,7 +387,7 @@ def get_label_values_per_deployer(namespace, label, deployerlabel):
     """
     unique_values = set()
     try:
-        values = check_output(['kubectl', 'get', 'all,cm,secrets', '--namespace', namespace, '--selector=' + deployerlabel, '-o',
+        values = _check_output(['kubectl', 'get', 'all,cm,secrets', '--namespace', namespace, '--selector=' + deployerlabel, '-o',
                                'jsonpath="{.items[*].metadata.labels[\'' + label + '\']}']).decode('utf-8')
         values = values.replace('"', '')
         for value in values.split(' '):
@@ -245,7 +417,7 @@ def add_label_to_resource(namespace, label, resource, resourcename, overwrite=Fa
     if overwrite:
         cmd.append('--overwrite')
     try:
-        check_call(cmd)
+        _check_call(cmd, PRIORITY_HIGH)
     except CalledProcessError as e:
         log(e)
 
@@ -262,7 +434,7 @@ def resource_owner(namespace, resource_name, label):
         owner (str)
     """
     try:
-        owner = check_output(["kubectl", "get", "all,cm,secrets", "-n", namespace, "-o"
+        owner = _check_output(["kubectl", "get", "all,cm,secrets", "-n", namespace, "-o"
              , 'jsonpath="{.items[?(@.metadata.name==\'' + resource_name + '\')].metadata.labels[\'' + label + '\']}"']).decode('utf-8')
         return owner.replace('"', '').split(' ')[0]
     except CalledProcessError as e:
@@ -282,7 +454,7 @@ def namespace_exists(namespace):
          True | False
     """
     try:
-        check_call(['kubectl', 'get', 'namespace', namespace])
+        _check_call(['kubectl', 'get', 'namespace', namespace])
     except CalledProcessError:
         return False
     return True
@@ -296,13 +468,13 @@ def delete_namespace(namespace):
      Return:
          True | False
     """
-    if not check_output(['kubectl',
-                         'get',
-                         'pods,services',
-                         '--namespace',
-                         namespace]):
+    if not _check_output(['kubectl',
+                          'get',
+                          'pods,services',
+                          '--namespace',
+                          namespace]):
         log('No resources found for namespace ' + namespace + ' ... deleting')
-        call(['kubectl', 'delete', 'namespace', namespace])
+        _call(['kubectl', 'delete', 'namespace', namespace], PRIORITY_HIGH)
         return True
     # log('Resources found for namespace ' + namespace + ', not deleting')
     return False
@@ -316,7 +488,7 @@ SERVICE HELPER METHODS
 
 def service_exists(namespace, name):
     try:
-        check_call(['kubectl', 'get', 'service', '-n', namespace, name])
+        _check_call(['kubectl', 'get', 'service', '-n', namespace, name])
     except CalledProcessError:
         return False
     return True
@@ -337,9 +509,9 @@ def secret_exists(secret, namespace):
         True | False
     """
     try:
-        check_call(['kubectl',
-                    '--namespace', namespace,
-                    'get', 'secret', secret])
+        _check_call(['kubectl',
+                     '--namespace', namespace,
+                     'get', 'secret', secret])
     except CalledProcessError:
         return False
     return True
@@ -353,7 +525,7 @@ def delete_secret(secret, namespace):
             namespace (str): namespace of the secret
     """
     try:
-        call(['kubectl', '--namespace', namespace, 'delete', 'secret', secret])
+        _call(['kubectl', '--namespace', namespace, 'delete', 'secret', secret], PRIORITY_HIGH)
     except CalledProcessError as e:
         log(e)
 
@@ -374,19 +546,19 @@ def create_secret(namespace, name, username, password, juju_app_label, deployer_
         Name of the secret
     """
     try:
-        output = check_output(['kubectl',
-                               '--namespace',
-                               namespace,
-                               'create',
-                               'secret',
-                               'docker-registry',
-                               name,
-                               '--docker-server=' + dockerregistry,
-                               '--docker-username=' + username,
-                               '--docker-password=' + password,
-                               '--docker-email=bogus@examplebogus.be'])
-        call(['kubectl', '--namespace', namespace, 'label', 'secrets', name, juju_app_label])
-        call(['kubectl', '--namespace', namespace, 'label', 'secrets', name, deployer_label])
+        output = _check_output(['kubectl',
+                                '--namespace',
+                                namespace,
+                                'create',
+                                'secret',
+                                'docker-registry',
+                                name,
+                                '--docker-server=' + dockerregistry,
+                                '--docker-username=' + username,
+                                '--docker-password=' + password,
+                                '--docker-email=bogus@examplebogus.be'], PRIORITY_HIGH)
+        _call(['kubectl', '--namespace', namespace, 'label', 'secrets', name, juju_app_label], PRIORITY_HIGH)
+        _call(['kubectl', '--namespace', namespace, 'label', 'secrets', name, deployer_label], PRIORITY_HIGH)
     except CalledProcessError as e:
         log(e)
 
@@ -405,7 +577,7 @@ def networkpolicy_exists(namespace, name):
         True | False
     """
     try:
-        check_call(['kubectl', 'get', 'networkpolicy', name, '-n', namespace])
+        _check_call(['kubectl', 'get', 'networkpolicy', name, '-n', namespace])
     except CalledProcessError:
         return False
     return True
@@ -418,6 +590,6 @@ def delete_networkpolicy(namespace, name):
         name (str): name of the networkpolicy
     """
     try:
-        call(['kubectl', 'delete', 'networkpolicy', name, '-n', namespace])
+        _call(['kubectl', 'delete', 'networkpolicy', name, '-n', namespace], PRIORITY_HIGH)
     except CalledProcessError as e:
         log(e)
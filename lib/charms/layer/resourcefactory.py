@@ -1,13 +1,21 @@
 import os
 import re
-import yaml
+import json
 import time
+import ipaddress
 from . import k8shelpers as k8s
 from charmhelpers.core.templating import render
 from charmhelpers.core import unitdata
-from charmhelpers.core.hookenv import log, config
+from charmhelpers.core.hookenv import log
 
-config = config()
+# Prefix of the annotations requesting charms use to configure the deployer
+DEPLOYER_ANNOTATION_PREFIX = 'kubernetes-deployer/'
+AUTOSCALE_KINDS = ['Deployment', 'StatefulSet', 'ReplicaSet']
+DISRUPTION_BUDGET_KINDS = ['Deployment', 'StatefulSet', 'ReplicaSet']
+# Same limit as the EndpointSlice controller of Kubernetes
+MAX_SLICE_ENDPOINTS = 100
+# Service spec fields a headless Service for external addresses sets itself
+HEADLESS_SERVICE_FIELDS = ['clusterIP', 'clusterIPs', 'ports', 'selector', 'type']
 
 
 class ResourceFactory(object):
@@ -19,6 +27,77 @@ class ResourceFactory(object):
             return Namespace(request)
         elif resource_type == 'network-policy':
             return NetworkPolicy(request)
+        elif resource_type == 'app-quota':
+            return AppQuota(request)
+        elif resource_type == 'limit-range':
+            return LimitRange(request)
+        elif resource_type == 'image-prepull':
+            return ImagePrePull(request)
+        elif resource_type == 'headless-service':
+            return HeadlessService(request)
+
+
+def deployer_annotation(resource, key, default=None):
+    """Return the value of the `kubernetes-deployer/<key>` annotation of a resource."""
+    annotations = (resource.get('metadata') or {}).get('annotations') or {}
+    return annotations.get(DEPLOYER_ANNOTATION_PREFIX + key, default)
+
+
+def int_or_percentage(value):
+    """Convert an annotation value to the int or percentage string Kubernetes expects."""
+    value = str(value).strip()
+    if value.endswith('%'):
+        int(value[:-1])
+        return value
+    return int(value)
+
+
+def pod_spec(resource):
+    """Return the pod spec of a workload resource or None
+    if the resource does not create pods.
+    """
+    spec = resource.get('spec') or {}
+    kind = resource.get('kind')
+    if kind == 'Pod':
+        return spec
+    if kind in ['Deployment', 'StatefulSet', 'DaemonSet', 'ReplicaSet', 'ReplicationController', 'Job']:
+        return (spec.get('template') or {}).get('spec')
+    if kind == 'CronJob':
+        return (((spec.get('jobTemplate') or {}).get('spec') or {}).get('template') or {}).get('spec')
+    return None
+
+
+def containers(resource):
+    """Return all (init) containers of a workload resource."""
+    spec = pod_spec(resource) or {}
+    return (spec.get('initContainers') or []) + (spec.get('containers') or [])
+
+
+def shard_addresses(previous, addresses, max_size):
+    """Spread addresses over slices of at most max_size addresses.
+    Addresses stay in the slice they were in, new addresses fill up the
+    first slices with room. Slices are never removed, only emptied, so a
+    change only touches the slices with changed addresses.
+
+    Args:
+        previous (list): previous slices, lists of addresses
+        addresses (list): addresses
+        max_size (int): max number of addresses per slice
+    Returns:
+        list of slices
+    """
+    wanted = set(addresses)
+    slices = [[address for address in addresses_slice if address in wanted] for addresses_slice in previous]
+    assigned = set(address for addresses_slice in slices for address in addresses_slice)
+    new = sorted(wanted - assigned)
+    for addresses_slice in slices:
+        room = max_size - len(addresses_slice)
+        addresses_slice.extend(new[:room])
+        new = new[room:]
+    while new:
+        slices.append(new[:max_size])
+        new = new[max_size:]
+    return slices
 
 
 class Resource(object):
@@ -30,6 +109,7 @@ class Resource(object):
         self.namespace_selector = unitdata.kv().get('namespace_selector')
         self.deployers_path = unitdata.kv().get('deployers_path')  # Path to all deployer dirs
         self.deployer_path = unitdata.kv().get('deployer_path')  # Path to this deployer dir
+        self.errors = []  # Problems with the request, reported in the status of the requesting app
 
     def create_resource(self):
         raise NotImplementedError()
@@ -52,11 +132,57 @@ class PreparedResource(Resource):
         'unique_id': an id needed to generate unique file names, MUST be INT,
         'model_uuid': uuid of the model requesting the resource,
         'juju_unit': name of the juju unit requesting the resource,
+        'resource_dir': (optional) dir to write the resource file to,
+                        defaults to deployer_path/resources,
+        'priority_class': (optional) priority class set on all pods of the resource,
+        'image_digests': (optional) {image: digest}, matching images are pinned to
+                         their digest and pulled only if not present,
+        'pull_policy': (optional) imagePullPolicy of containers without a digest,
     }
     request contains the full resource file in a dict
+
+    Deployments, StatefulSets and ReplicaSets with a `kubernetes-deployer/max-replicas`
+    annotation (and optionally `min-replicas` and `target-cpu-utilization`)
+    get a HorizontalPodAutoscaler, written to the same resource file.
+
+    Deployments can set their rollout with the `max-surge`, `max-unavailable`
+    (count or percentage), `progress-deadline` and `min-ready-seconds` annotations.
+    Deployments, StatefulSets and ReplicaSets with a `pdb-min-available` or
+    `pdb-max-unavailable` annotation get a PodDisruptionBudget, written to the
+    same resource file.
     """
     def write_resource_file(self):
-        # Fill in namespace and labels
+        import yaml
+        self.add_labels()
+        spec = pod_spec(self.request['resource'])
+        if spec is not None and self.request.get('priority_class'):
+            if spec.get('priorityClassName', self.request['priority_class']) == self.request['priority_class']:
+                spec['priorityClassName'] = self.request['priority_class']
+            else:
+                # Keep the scheduling priority the app asked for, its pods are not under the quota
+                self.errors.append('priorityClassName of resource {} conflicts with the app quota'.format(
+                    self.request['resource']['metadata'].get('name', '')))
+        for container in containers(self.request['resource']):
+            digest = self.request.get('image_digests', {}).get(container.get('image'))
+            if digest:
+                container['image'] = container['image'] + '@' + digest
+                container['imagePullPolicy'] = 'IfNotPresent'
+            elif self.request.get('pull_policy'):
+                container['imagePullPolicy'] = self.request['pull_policy']
+        documents = [self.request['resource']]
+        self.set_rollout_strategy()
+        disruption_budget = self.disruption_budget()
+        if disruption_budget:
+            documents.append(disruption_budget)
+        autoscaler = self.autoscaler()
+        if autoscaler:
+            documents.append(autoscaler)
+
+        with open(self.resource_path(), 'w+') as f:
+            yaml.dump_all(documents, f)
+
+    def add_labels(self):
+        """Fill in the namespace and the deployer labels of the resource."""
         # Check needed for valid metadata tag (if it even exists??)
         if 'metadata' not in self.request['resource']:
             self.request['resource']['metadata'] = {}
@@ -68,13 +194,129 @@ class PreparedResource(Resource):
         self.request['resource']['metadata']['labels']['model_uuid'] = self.request['model_uuid']
         self.request['resource']['metadata']['labels']['juju_unit'] = self.request['juju_unit']
 
-        with open(self.deployer_path +
-                  '/resources/' +
-                  self.request['uuid'] +
-                  '-' +
-                  str(self.request['unique_id']) +
-                  '.yaml', 'w+') as f:
-            yaml.dump(self.request['resource'], f)
+    def annotation(self, key, convert):
+        """Return the converted value of a deployer annotation of the resource,
+        None if it is not set or invalid. Invalid values are added to the errors.
+        """
+        value = deployer_annotation(self.request['resource'], key)
+        if value is None:
+            return None
+        try:
+            return convert(value)
+        except ValueError:
+            self.errors.append('Invalid annotation {}{} of resource {}: {}'.format(
+                DEPLOYER_ANNOTATION_PREFIX, key, self.request['resource']['metadata'].get('name', ''), value))
+            return None
+
+    def set_rollout_strategy(self):
+        """Apply the rollout annotations to the spec of a Deployment."""
+        resource = self.request['resource']
+        if resource.get('kind') != 'Deployment':
+            return
+        spec = resource.setdefault('spec', {})
+        max_surge = self.annotation('max-surge', int_or_percentage)
+        max_unavailable = self.annotation('max-unavailable', int_or_percentage)
+        if max_surge is not None or max_unavailable is not None:
+            # Keep the rolling update settings of the request the annotations do not set
+            strategy = spec.get('strategy') or {}
+            strategy['type'] = 'RollingUpdate'
+            rolling_update = strategy.get('rollingUpdate') or {}
+            if max_surge is not None:
+                rolling_update['maxSurge'] = max_surge
+            if max_unavailable is not None:
+                rolling_update['maxUnavailable'] = max_unavailable
+            strategy['rollingUpdate'] = rolling_update
+            spec['strategy'] = strategy
+        progress_deadline = self.annotation('progress-deadline', int)
+        if progress_deadline is not None:
+            spec['progressDeadlineSeconds'] = progress_deadline
+        min_ready_seconds = self.annotation('min-ready-seconds', int)
+        if min_ready_seconds is not None:
+            spec['minReadySeconds'] = min_ready_seconds
+
+    def disruption_budget(self):
+        """Return a PodDisruptionBudget for the resource if it requests one, None otherwise."""
+        resource = self.request['resource']
+        if resource.get('kind') not in DISRUPTION_BUDGET_KINDS:
+            return None
+        min_available = self.annotation('pdb-min-available', int_or_percentage)
+        max_unavailable = self.annotation('pdb-max-unavailable', int_or_percentage)
+        if min_available is None and max_unavailable is None:
+            return None
+        spec = resource.get('spec') or {}
+        selector = spec.get('selector') or {
+            'matchLabels': ((spec.get('template') or {}).get('metadata') or {}).get('labels') or {}
+        }
+        disruption_budget = {
+            'apiVersion': 'policy/v1',
+            'kind': 'PodDisruptionBudget',
+            'metadata': {
+                'name': resource['metadata']['name'],
+                'namespace': self.request['namespace'],
+                'labels': dict(resource['metadata']['labels']),
+            },
+            'spec': {
+                'selector': selector,
+            },
+        }
+        # Only one of both can be set
+        if min_available is not None:
+            disruption_budget['spec']['minAvailable'] = min_available
+        else:
+            disruption_budget['spec']['maxUnavailable'] = max_unavailable
+        return disruption_budget
+
+    def autoscaler(self):
+        """Return a HorizontalPodAutoscaler for the resource if it requests
+        autoscaling, None otherwise. The replica count of the resource is set to
+        the live count so applying the resource does not undo the autoscaler.
+        """
+        resource = self.request['resource']
+        if resource.get('kind') not in AUTOSCALE_KINDS or deployer_annotation(resource, 'max-replicas') is None:
+            return None
+        try:
+            min_replicas = int(deployer_annotation(resource, 'min-replicas', 1))
+            max_replicas = int(deployer_annotation(resource, 'max-replicas'))
+            target = deployer_annotation(resource, 'target-cpu-utilization')
+            target = int(target) if target is not None else None
+        except ValueError:
+            log('Invalid autoscaling annotations for resource: ' + resource['metadata'].get('name', ''))
+            return None
+        spec = resource.setdefault('spec', {})
+        live = k8s.get_resource_by_name_type(resource['metadata']['name'],
+                                             self.request['namespace'],
+                                             resource['kind'].lower())
+        if live:
+            spec['replicas'] = live['spec'].get('replicas', min_replicas)
+        else:
+            spec['replicas'] = min(max(spec.get('replicas', min_replicas), min_replicas), max_replicas)
+        autoscaler = {
+            'apiVersion': 'autoscaling/v1',
+            'kind': 'HorizontalPodAutoscaler',
+            'metadata': {
+                'name': resource['metadata']['name'],
+                'namespace': self.request['namespace'],
+                'labels': dict(resource['metadata']['labels']),
+            },
+            'spec': {
+                'scaleTargetRef': {
+                    'apiVersion': resource['apiVersion'],
+                    'kind': resource['kind'],
+                    'name': resource['metadata']['name'],
+                },
+                'minReplicas': min_replicas,
+                'maxReplicas': max_replicas,
+            },
+        }
+        if target is not None:
+            autoscaler['spec']['targetCPUUtilizationPercentage'] = target
+        return autoscaler
+
+    def resource_dir(self):
+        return self.request.get('resource_dir', self.deployer_path + '/resources')
+
+    def resource_path(self):
+        return self.resource_dir() + '/' + self.request['uuid'] + '-' + str(self.request['unique_id']) + '.yaml'
 
     def delete_resource(self):
         # WARNING This will delete ALL resources requested from the juju unit
@@ -153,6 +395,211 @@ class Namespace(Resource):
                 os.remove(path)
 
     def delete_namespace_resources(self):
-        resources = ['services', 'deployments', 'endpoints', 'secrets']
+        resources = ['services', 'deployments', 'endpoints', 'secrets', 'resourcequotas', 'limitranges',
+                     'poddisruptionbudgets', 'horizontalpodautoscalers']
         k8s.delete_resources_by_label(self.request['name'],
                                       resources, self.deployer_selector + '=' + self.request['deployer'])
+        # Separate call since older clusters do not serve EndpointSlices
+        k8s.delete_resources_by_label(self.request['name'],
+                                      ['endpointslices'], self.deployer_selector + '=' + self.request['deployer'])
+
+
+class AppQuota(Resource):
+    """request = {
+        'uuid': uuid of the juju unit the quota applies to,
+        'namespace': namespace of the quota,
+        'hard': ResourceQuota hard limits, e.g. {'limits.cpu': '2'},
+        'model_uuid': uuid of the model requesting the resources,
+        'juju_unit': name of the juju unit requesting the resources,
+        'resource_dir': (optional) dir to write the resource file to,
+                        defaults to deployer_path/resources
+    }
+    ResourceQuotas can not select pods by label, so every app gets its own
+    PriorityClass which scopes the quota and is set on all pods of the app.
+    """
+    def resource_path(self):
+        return (self.request.get('resource_dir', self.deployer_path + '/resources') +
+                '/' + self.request['uuid'] + '-quota.yaml')
+
+    def write_resource_file(self):
+        render(source='app-quota.tmpl',
+               target=self.resource_path(),
+               context={
+                   'name': self.name(),
+                   'namespace': self.request['namespace'],
+                   'uuid': self.request['uuid'],
+                   'hard': self.request['hard'],
+                   'model_uuid': self.request['model_uuid'],
+                   'juju_unit': self.request['juju_unit'],
+                   'juju_selector': self.juju_app_selector,
+                   'deployer_selector': self.deployer_selector,
+                   'deployer': self.deployer_name,
+               })
+
+    def name(self):
+        # PriorityClasses are not namespaced
+        return self.deployer_name + '-' + self.request['uuid']
+
+    def create_resource(self):
+        # Applied on its own, before the resources of the app which use the PriorityClass
+        return k8s.create_resources(self.resource_path())
+
+    def delete_resource(self):
+        if os.path.exists(self.resource_path()):
+            k8s.delete_resource_by_file(self.resource_path())
+            os.remove(self.resource_path())
+
+
+class LimitRange(Resource):
+    """request = {
+        'namespace': namespace of the limit range,
+        'limits': default container limits, e.g. {'cpu': '500m'}
+    }
+    """
+    def resource_path(self):
+        return self.deployer_path + '/limits/limit-range.yaml'
+
+    def write_resource_file(self):
+        if not os.path.exists(self.deployer_path + '/limits'):
+            os.makedirs(self.deployer_path + '/limits')
+        render(source='limit-range.tmpl',
+               target=self.resource_path(),
+               context={
+                   'name': self.name(),
+                   'namespace': self.request['namespace'],
+                   'limits': self.request['limits'],
+                   'deployer_selector': self.deployer_selector,
+                   'deployer': self.deployer_name,
+               })
+
+    def name(self):
+        return self.deployer_name + '-defaults'
+
+    def create_resource(self):
+        return k8s.create_resources(self.deployer_path)
+
+    def delete_resource(self):
+        if os.path.exists(self.resource_path()):
+            k8s.delete_resource_by_file(self.resource_path())
+            os.remove(self.resource_path())
+
+
+class ImagePrePull(Resource):
+    """request = {
+        'namespace': namespace to run the pre-pull DaemonSet in,
+        'images': images to pull on every node,
+        'pull_secrets': names of the image pull secrets,
+        'timeout': max seconds to wait for the images
+    }
+    """
+    def resource_path(self):
+        return self.deployers_path + '/prepull/' + self.name() + '.yaml'
+
+    def write_resource_file(self):
+        if not os.path.exists(self.deployers_path + '/prepull'):
+            os.makedirs(self.deployers_path + '/prepull')
+        render(source='image-prepull.tmpl',
+               target=self.resource_path(),
+               context={
+                   'name': self.name(),
+                   'namespace': self.request['namespace'],
+                   'images': self.request['images'],
+                   'pull_secrets': self.request.get('pull_secrets', []),
+                   'deployer_selector': self.deployer_selector,
+                   'deployer': self.deployer_name,
+               })
+
+    def name(self):
+        # Every deployer unit pre-pulls the images of its own shard
+        return os.environ['JUJU_UNIT_NAME'].replace('/', '-') + '-prepull'
+
+    def create_resource(self):
+        """Run the DaemonSet and wait until every node has pulled all images.
+
+        Returns:
+            True if all images were pulled before the timeout, False otherwise.
+        """
+        if not k8s.create_resources(self.resource_path()):
+            return False
+        deadline = time.monotonic() + self.request.get('timeout', 300)
+        while time.monotonic() < deadline:
+            daemonset = k8s.get_resource_by_name_type(self.name(), self.request['namespace'], 'daemonset')
+            desired = ((daemonset or {}).get('status') or {}).get('desiredNumberScheduled')
+            pods = k8s.get_resources_by_label(self.request['namespace'], ['pods'], 'prepull=' + self.name())
+            # A container gets an imageID once its image is pulled, even if it does not run
+            if desired and len(pods) >= desired and all(self._pulled(pod) for pod in pods):
+                return True
+            time.sleep(5)
+        return False
+
+    def _pulled(self, pod):
+        statuses = (pod.get('status') or {}).get('containerStatuses') or []
+        return len(statuses) == len(self.request['images']) and all(s.get('imageID') for s in statuses)
+
+    def delete_resource(self):
+        if os.path.exists(self.resource_path()):
+            k8s.delete_resource_by_file(self.resource_path())
+            os.remove(self.resource_path())
+
+
+class HeadlessService(PreparedResource):
+    """request: see PreparedResource, the resource is a Service with a
+    `kubernetes-deployer/external-ips` annotation (comma separated addresses)
+
+    Creates a headless Service for addresses outside of the cluster, backed by
+    EndpointSlices of at most MAX_SLICE_ENDPOINTS addresses each.
+    """
+    def write_resource_file(self):
+        self.add_labels()
+        resource = self.request['resource']
+        name = resource['metadata']['name']
+        addresses = {'IPv4': [], 'IPv6': []}
+        for address in deployer_annotation(resource, 'external-ips', '').split(','):
+            try:
+                address = ipaddress.ip_address(address.strip())
+            except ValueError:
+                log('Invalid external ip for service ' + name + ': ' + address)
+                continue
+            addresses['IPv{}'.format(address.version)].append(str(address))
+        ports = []
+        for port in (resource.get('spec') or {}).get('ports') or []:
+            ports.append({
+                'name': port.get('name'),
+                'port': port['port'],
+                'protocol': port.get('protocol', 'TCP'),
+                'target_port': port['targetPort'] if isinstance(port.get('targetPort'), int) else port['port'],
+            })
+        # Keep addresses in the same slice as the previous time
+        state_key = 'endpointslices.{}.{}'.format(self.request['namespace'], name)
+        previous = unitdata.kv().get(state_key, {})
+        state = {}
+        slices = []
+        for address_type in sorted(addresses):
+            state[address_type] = shard_addresses(previous.get(address_type, []),
+                                                  addresses[address_type],
+                                                  MAX_SLICE_ENDPOINTS)
+            for index, addresses_slice in enumerate(state[address_type]):
+                slices.append({
+                    'name': '{}-{}-{}'.format(name, address_type.lower(), index),
+                    'address_type': address_type,
+                    'addresses': addresses_slice,
+                })
+        # Files written to another dir (e.g. for a dry run) are not applied
+        if 'resource_dir' not in self.request:
+            unitdata.kv().set(state_key, state)
+            unitdata.kv().set('used-endpointslices',
+                              unitdata.kv().get('used-endpointslices', []) + [state_key])
+        # The other fields of the spec are kept, JSON is valid YAML
+        spec = {key: json.dumps(value) for key, value in (resource.get('spec') or {}).items()
+                if key not in HEADLESS_SERVICE_FIELDS}
+        render(source='headless-service.tmpl',
+               target=self.resource_path(),
+               context={
+                   'name': name,
+                   'namespace': self.request['namespace'],
+                   'labels': resource['metadata']['labels'],
+                   'ports': ports,
+                   'spec': spec,
+                   'slices': slices,
+                   'managed_by': 'kubernetes-deployer',
+               })
@@ -0,0 +1,27 @@
+import bisect
+import hashlib
+
+
+# Points per member on the ring, more points spread the keys more evenly
+VIRTUAL_NODES = 128
+
+
+class HashRing(object):
+    """Consistent hash ring assigning keys to members.
+    Adding or removing a member only moves the keys of that member.
+    """
+    def __init__(self, members, virtual_nodes=VIRTUAL_NODES):
+        self.ring = sorted((_hash('{}#{}'.format(member, i)), member)
+                           for member in members
+                           for i in range(virtual_nodes))
+        self.hashes = [point for point, _ in self.ring]
+
+    def owner(self, key):
+        """Return the member responsible for key, None if the ring is empty."""
+        if not self.ring:
+            return None
+        return self.ring[bisect.bisect(self.hashes, _hash(key)) % len(self.ring)][1]
+
+
+def _hash(key):
+    return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:16], 16)
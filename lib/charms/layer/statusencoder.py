@@ -0,0 +1,87 @@
+import json
+import zlib
+import base64
+
+
+# Bumped whenever the layout of an encoded status changes. A status that is
+# sent without envelope (no field projection, no compression) is version 1.
+STATUS_FORMAT_VERSION = 2
+
+
+def encode_status(status, fields=None, compress=False):
+    """Encode the status that is sent over the relation.
+
+    Without fields and compression the status is returned as is. Otherwise
+    every resource is projected to the given fields and the result is wrapped
+    in an envelope:
+        {
+            'format-version': 2,
+            'encoding': 'json' | 'zlib+base64',
+            'data': projected status or compressed, base64 encoded json
+        }
+
+    Args:
+        status (dict): {'uuid': [resource, ...] | {'error': ...}, ...}
+        fields (list): dotted field paths to keep, e.g. ['metadata.name', 'spec.ports.nodePort']
+        compress (bool): compress the projected status
+    Returns:
+        dict
+    """
+    if not fields and not compress:
+        return status
+    if fields:
+        status = {uuid: [project_resource(r, fields) for r in resources] if isinstance(resources, list) else resources
+                  for uuid, resources in status.items()}
+    envelope = {
+        'format-version': STATUS_FORMAT_VERSION,
+        'encoding': 'json',
+        'data': status,
+    }
+    if compress:
+        data = json.dumps(status, sort_keys=True, separators=(',', ':')).encode('utf-8')
+        envelope['encoding'] = 'zlib+base64'
+        envelope['data'] = base64.b64encode(zlib.compress(data, 9)).decode('ascii')
+    return envelope
+
+
+def decode_status(payload):
+    """Inverse of encode_status, for consumers of the relation data."""
+    if payload.get('format-version') != STATUS_FORMAT_VERSION:
+        return payload
+    if payload['encoding'] == 'zlib+base64':
+        return json.loads(zlib.decompress(base64.b64decode(payload['data'])).decode('utf-8'))
+    return payload['data']
+
+
+def project_resource(resource, fields):
+    """Return a copy of resource with only the given fields.
+    Lists are projected element-wise, `kubectl get` Lists item-wise.
+
+    Args:
+        resource (dict): resource as returned by kubectl
+        fields (list): dotted field paths
+    Returns:
+        dict or None
+    """
+    if resource is None:
+        return None
+    if resource.get('kind') == 'List' and 'items' in resource:
+        return {'kind': 'List', 'items': [project_resource(item, fields) for item in resource['items']]}
+    result = {}
+    for field in fields:
+        _copy_field(resource, result, field.split('.'))
+    return result
+
+
+def _copy_field(source, target, path):
+    if not isinstance(source, dict) or path[0] not in source:
+        return
+    value = source[path[0]]
+    if len(path) == 1:
+        target[path[0]] = value
+    elif isinstance(value, list):
+        projected = target.setdefault(path[0], [{} for _ in value])
+        for item, projected_item in zip(value, projected):
+            _copy_field(item, projected_item, path[1:])
+    elif isinstance(value, dict):
+        _copy_field(value, target.setdefault(path[0], {}), path[1:])
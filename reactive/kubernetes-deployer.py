@@ -1,12 +1,14 @@
 #!/usr/bin/env python3
 import os
+import re
+import sys
+import time
 import json
-import shutil
+import hashlib
 from subprocess import (
-    run,
     CalledProcessError,
-    PIPE,
     check_output,
+    check_call,
 )
 from collections import defaultdict
 from charms.reactive import (
@@ -18,16 +20,22 @@ from charms.reactive import (
     clear_flag,
     when_any,
     data_changed,
+    is_flag_set,
 )
-from charms.reactive.relations import endpoint_from_flag
+from charms.reactive.relations import endpoint_from_flag, endpoint_from_name
+from charms.leadership import leader_get, leader_set
 from charmhelpers.core.hookenv import (
     log,
     status_set,
     charm_dir,
+    action_set,
+    action_fail,
 )
 from charmhelpers.core import unitdata, hookenv, host
-from jujubigdata import utils
-from charms.layer.resourcefactory import ResourceFactory
+from charmhelpers.core.templating import render
+from charms.layer.resourcefactory import ResourceFactory, containers, pod_spec, deployer_annotation
+from charms.layer.statusencoder import encode_status
+from charms.layer.sharding import HashRing
 from charms.layer.k8shelpers import (
     delete_resources_by_label,
     get_label_values_per_deployer,
@@ -35,13 +43,26 @@ from charms.layer.k8shelpers import (
     get_worker_node_ips,
     resource_owner,
     get_resource_by_file,
+    delete_resource_by_file,
+    get_resources_by_label,
+    dry_run_resources,
+    MANAGED_RESOURCE_TYPES,
 )
 
 
+# Every hook, including the frequent update-status, imports this module.
+# Dependencies only needed by a few handlers are imported in those handlers.
+
 # Add kubectl to PATH
 os.environ['PATH'] += os.pathsep + os.path.join(os.sep, 'snap', 'bin')
 config = hookenv.config()
 deployer = os.environ['JUJU_UNIT_NAME'].split('/')[0]
+# Resource types the reconciler watches for drift. Autoscalers, disruption
+# budgets and quotas are left out, their status changes all the time.
+reconciler_watch_types = ['deployments', 'statefulsets', 'daemonsets', 'services',
+                          'configmaps', 'secrets', 'endpointslices']
+# Config options holding a YAML mapping
+yaml_config_options = ['app-quota', 'default-limits']
 
 
 @when_not('kube-host.available')
@@ -62,6 +83,7 @@ def check_master_ready(kube):
 
 @when_not('deployer.installed')
 def install_deployer():
+    from jujubigdata import utils
     # Create user and configuration dir
     distconfig = utils.DistConfig(filename=charm_dir() + '/files/setup.yaml')
     distconfig.add_users()
@@ -93,9 +115,13 @@ def install_deployer():
 
 @when('endpoint.kubernetes-deployer.resources-changed',
       'kube-host.available',
-      'kubernetes.ready',
-      'leadership.is_leader')
+      'kubernetes.ready')
 def new_resource_request(dep, kube):
+    # Actions run the reactive dispatch too, they must not change anything
+    if hookenv.action_name():
+        return
+    if invalid_yaml_configs():
+        return
     status_set('active', 'Processing resource requests')
     configure_namespace()
     requests = dep.get_resource_requests()
@@ -104,9 +130,26 @@ def new_resource_request(dep, kube):
     # Store all uuids in the kv store so we can check later in the cleanup handler 
     # which are still in use (= still have a relation with the deployer)
     unitdata.kv().set('used_apps', list(requests.keys()))
+    # Headless services record the EndpointSlice state they still use
+    unitdata.kv().set('used-endpointslices', [])
     error_states = {}
-    for uuid in requests:
+    # Every deployer unit only creates the resources of its own shard
+    uuids = shard(requests)
+    digests = {uuid: image_digests(uuid, requests[uuid]) for uuid in uuids}
+    forget_image_digests(requests)
+    # The blocking pre-pull would hold up the hook the reconciler is meant to keep short
+    if config.get('prepull-images') and not config.get('reconciler'):
+        prepull_images({uuid: requests[uuid] for uuid in uuids}, digests)
+    without_quota = []
+    for uuid in uuids:
         resource_id = 0
+        quota = prepare_quota(uuid, requests[uuid])
+        if quota:
+            # Pods of the app can only be created once their PriorityClass exists
+            quota.write_resource_file()
+            quota.create_resource()
+        else:
+            without_quota.append(uuid)
         for resource in requests[uuid]['requests']:
             # Check if there is a naming conflict in the namespace
             if resource_name_duplicate(resource, uuid):
@@ -114,19 +157,28 @@ def new_resource_request(dep, kube):
                                                + resource['metadata']['name']}
                 log('Duplicate name for resource: ' + resource['metadata']['name'])
                 continue
-            prepared_request = {
-                'uuid': uuid,
-                'resource': resource,
-                'namespace': config.get('namespace').rstrip(),
-                'unique_id': resource_id,
-                'model_uuid': requests[uuid]['model_uuid'],
-                'juju_unit': requests[uuid]['juju_unit'],
-            }
+            pre_resource = prepare_resource(uuid, requests[uuid], resource, resource_id,
+                                            priority_class=quota.name() if quota else None,
+                                            image_digests=digests[uuid])
             resource_id += 1
-            pre_resource = ResourceFactory.create_resource('preparedresource', prepared_request)
             pre_resource.write_resource_file()
+            if pre_resource.errors:
+                error_states[uuid] = {'error': ', '.join(pre_resource.errors)}
+                log('Invalid request: ' + ', '.join(pre_resource.errors))
+            # The reconciler applies the resource files
+            if config.get('reconciler'):
+                continue
             if not pre_resource.create_resource():
                 error_states[uuid] = {'error': 'Could not create requested resources.'}
+    if without_quota:
+        # Remove quotas of apps which no longer want one
+        delete_resources_by_label(config.get('namespace').rstrip(),
+                                  ['resourcequotas', 'priorityclasses'],
+                                  '{}={},{} in ({})'.format(unitdata.kv().get('deployer_selector'), deployer,
+                                                            unitdata.kv().get('juju_app_selector'),
+                                                            ','.join(without_quota)))
+    if config.get('reconciler'):
+        host.service_reload(reconciler_service())
     # Save the error states so update_status_info handler can report them
     unitdata.kv().set('error-states', error_states)
     if error_states:
@@ -139,14 +191,28 @@ def new_resource_request(dep, kube):
 
 @when('endpoint.kubernetes-deployer.available',
       'kube-host.available',
-      'kubernetes.ready',
-      'leadership.is_leader')
+      'kubernetes.ready')
 @when_not('endpoint.kubernetes-deployer.resources-changed')
 def update_status_info():
+    if hookenv.action_name():
+        return
     endpoint = endpoint_from_flag('endpoint.kubernetes-deployer.available')
     status = check_predefined_resources()
     error_states = unitdata.kv().get('error-states', {})
+    if config.get('reconciler'):
+        error_states = dict(report_reconciler_state(status), **error_states)
     status.update(error_states)
+    fields = [f.strip() for f in config.get('status-fields', '').split(',') if f.strip()]
+    if not hookenv.is_leader():
+        # Only the leader reports the status, it collects the status of
+        # the other shards over the peer relation
+        shard_status = json.dumps(encode_status(status, fields, compress=True), sort_keys=True)
+        if data_changed('shard-status', shard_status):
+            for relation_id in hookenv.relation_ids('deployers'):
+                hookenv.relation_set(relation_id, {'shard-status': shard_status})
+        return
+    status = dict(peer_shard_status(), **status)
+    status = encode_status(status, fields, config.get('status-compression', False))
     worker_ips = get_worker_node_ips()
     # Only report if the status has changed
     if (data_changed('status-info', status) 
@@ -155,28 +221,192 @@ def update_status_info():
         endpoint.send_worker_ips(worker_ips)
         
 
+@when('actions.diff')
+def diff_action():
+    """Preview what applying the current resource requests would do
+    with one server-side dry run for all requests.
+    """
+    import tempfile
+    clear_flag('actions.diff')
+    if not is_flag_set('kubernetes.ready'):
+        action_fail('Kubernetes is not ready yet.')
+        return
+    if invalid_yaml_configs():
+        action_fail('Config options app-quota and default-limits must be YAML mappings.')
+        return
+    namespace = config.get('namespace').rstrip()
+    requests = endpoint_from_name('kubernetes-deployer').get_resource_requests()
+    results = defaultdict(lambda: defaultdict(list))
+    owners = {}
+    with tempfile.TemporaryDirectory() as resource_dir:
+        for uuid in requests:
+            resource_id = 0
+            digests = image_digests(uuid, requests[uuid], update_cache=False)
+            quota = prepare_quota(uuid, requests[uuid], resource_dir=resource_dir)
+            if quota:
+                quota.write_resource_file()
+                owners[quota.name()] = uuid
+            for resource in requests[uuid]['requests']:
+                if resource_name_duplicate(resource, uuid):
+                    results[uuid]['errors'].append('Duplicate name for resource: ' + resource['metadata']['name'])
+                    continue
+                pre_resource = prepare_resource(uuid, requests[uuid], resource, resource_id,
+                                                resource_dir=resource_dir,
+                                                priority_class=quota.name() if quota else None,
+                                                image_digests=digests)
+                resource_id += 1
+                pre_resource.write_resource_file()
+                if pre_resource.errors:
+                    results[uuid]['errors'].extend(pre_resource.errors)
+                owners[resource['metadata']['name']] = uuid
+        start = time.monotonic()
+        changes, error = dry_run_resources(resource_dir) if owners else ([], None)
+        duration = time.monotonic() - start
+    actions = {'created': 'created', 'configured': 'changed', 'unchanged': 'unchanged'}
+    for resource, action in changes:
+        resource_type, name = resource.split('/', 1)
+        if resource_type.startswith('endpointslice'):
+            # EndpointSlices are named after the headless Service they belong to
+            name = re.sub(r'-ipv[46]-\d+$', '', name)
+        uuid = owners.get(name)
+        if uuid:
+            results[uuid][actions[action]].append(resource)
+    # Resources of apps without a request are removed by the cleanup handler
+    for resource in get_resources_by_label(namespace,
+                                           MANAGED_RESOURCE_TYPES,
+                                           unitdata.kv().get('deployer_selector') + '=' + deployer):
+        # Objects owned by another object (e.g. pods of a ReplicaSet) go together with their owner
+        if resource['metadata'].get('ownerReferences'):
+            continue
+        uuid = resource['metadata'].get('labels', {}).get(unitdata.kv().get('juju_app_selector'))
+        if uuid and uuid not in requests:
+            results[uuid]['pruned'].append(resource['kind'].lower() + '/' + resource['metadata']['name'])
+    if error:
+        if not changes:
+            action_fail('Dry run failed: ' + error)
+            return
+        action_set({'errors': error})
+    output = {'duration': '{:.2f}s'.format(duration)}
+    for uuid, result in results.items():
+        for key, resources in result.items():
+            output['{}.{}'.format(uuid, key)] = ', '.join(resources)
+    action_set(output)
+
+
+@when('deployer.installed',
+      'endpoint.kubernetes-deployer.available')
+@when_any('config.changed.app-quota',
+          'config.changed.default-limits',
+          'config.changed.pin-image-digests',
+          'config.changed.image-pull-policy')
+def resource_config_changed():
+    # Process all requests again so the new config is applied to them
+    set_flag('endpoint.kubernetes-deployer.resources-changed')
+
+
+"""
+RECONCILER STATES
+"""
+
+
+@when('deployer.installed')
+@when_any('config.changed.reconciler',
+          'config.changed.reconcile-interval',
+          'config.changed.namespace')
+def configure_reconciler():
+    service = reconciler_service()
+    service_file = '/etc/systemd/system/' + service + '.service'
+    if not config.get('reconciler'):
+        remove_reconciler()
+        return
+    render(source='reconciler.service.tmpl',
+           target=service_file,
+           context={
+               'unit': hookenv.local_unit(),
+               # The charm's python, the reconciler needs its yaml module
+               'python': sys.executable,
+               'charm_dir': charm_dir(),
+               'path': unitdata.kv().get('deployer_path'),
+               'namespace': config.get('namespace').rstrip(),
+               'selector': unitdata.kv().get('deployer_selector') + '=' + deployer,
+               'types': ','.join(reconciler_watch_types),
+               'interval': config.get('reconcile-interval'),
+               'state_file': unitdata.kv().get('deployer_path') + '/reconciler.state',
+           },
+           perms=0o644)
+    check_call(['systemctl', 'daemon-reload'])
+    host.service('enable', service)
+    host.service_restart(service)
+
+
+"""
+SHARDING STATES
+"""
+
+
+@hook('leader-elected',
+      'deployers-relation-joined',
+      'deployers-relation-departed')
+def deployer_units_changed():
+    # Remember the peers which take over the shard of this unit when it is removed.
+    # A unit that is removed itself sees all its peers depart, those are kept.
+    peers = set(unitdata.kv().get('deployer-peers', []))
+    for relation_id in hookenv.relation_ids('deployers'):
+        peers.update(hookenv.related_units(relation_id))
+    if hookenv.hook_name() == 'deployers-relation-departed' and hookenv.departing_unit() != hookenv.local_unit():
+        peers.discard(hookenv.remote_unit())
+    unitdata.kv().set('deployer-peers', sorted(peers))
+    if hookenv.is_leader():
+        publish_shard_members()
+
+
+@when('leadership.is_leader')
+@when_not('leadership.set.shard-members')
+def init_shard_members():
+    publish_shard_members()
+
+
+@when('deployer.installed',
+      'endpoint.kubernetes-deployer.available',
+      'leadership.changed.shard-members')
+def shard_members_changed():
+    # Process all requests again so this unit picks up its new shard
+    set_flag('endpoint.kubernetes-deployer.resources-changed')
+
+
 """
 CLEANUP STATES
 """
 
 
-@when('resources.created',
-      'leadership.is_leader')
+@when('resources.created')
 def cleanup():
+    if hookenv.action_name():
+        return
     # Iterate over all resources with label from this deployer
-    # Remove all which are not needed anymore
+    # Remove all from this unit's shard which are not needed anymore
     needed_apps = unitdata.kv().get('used_apps', [])
     all_apps = get_label_values_per_deployer(config.get('namespace').rstrip(),
                                              unitdata.kv().get('juju_app_selector'),
                                              unitdata.kv().get('deployer_selector') + '=' +
                                              os.environ['JUJU_UNIT_NAME'].split('/')[0])
-    for app in all_apps:
+    for app in shard(all_apps):
         if app not in needed_apps:
             # Remove resource via label
             delete_resources_by_label(config.get('namespace').rstrip(),
-                                      ['all,cm,secrets'],
+                                      MANAGED_RESOURCE_TYPES,
+                                      unitdata.kv().get('juju_app_selector') + '=' + app)
+            # Separate call since older clusters do not serve EndpointSlices
+            delete_resources_by_label(config.get('namespace').rstrip(),
+                                      ['endpointslices'],
                                       unitdata.kv().get('juju_app_selector') + '=' + app)
     unitdata.kv().set('used_apps', [])
+    # Forget the EndpointSlices of services which are no longer requested
+    used_endpointslices = unitdata.kv().get('used-endpointslices', [])
+    unused_endpointslices = [key for key in unitdata.kv().getrange('endpointslices.')
+                             if key not in used_endpointslices]
+    if unused_endpointslices:
+        unitdata.kv().unsetrange(unused_endpointslices)
 
     if config.changed('namespace') and config.previous('namespace').rstrip():
         log('Checking if previous namespace still has resources, if not delete namespace (' +
@@ -189,12 +419,16 @@ def cleanup():
 
 @hook('stop')
 def clean_deployer_configs():
-    path = unitdata.kv().get('deployer_path') + '/resources'
-    for file in os.listdir(path):
-        try:
-            run(['kubectl', 'delete', '-f', path + '/' + file])
-        except CalledProcessError as e:
-            log(e)
+    import shutil
+    # Stop the reconciler first, it would recreate the resources
+    remove_reconciler()
+    if unitdata.kv().get('deployer-peers'):
+        # The remaining deployer units take over the resources of this shard
+        log('Other deployer units remain, not deleting the resources of this unit')
+    else:
+        path = unitdata.kv().get('deployer_path') + '/resources'
+        for file in os.listdir(path):
+            delete_resource_by_file(path + '/' + file)
     shutil.rmtree(unitdata.kv().get('deployer_path'))
 
 
@@ -202,6 +436,8 @@ def clean_deployer_configs():
       'config.changed.isolated',
       'leadership.is_leader')
 def create_policies():
+    if invalid_yaml_configs():
+        return
     configure_namespace()
     request = {
         'namespace': config['namespace'].rstrip(''),
@@ -217,12 +453,105 @@ def create_policies():
     policy.create_resource()
 
 
+def reconciler_service():
+    return 'kubedeployer-reconciler-' + os.environ['JUJU_UNIT_NAME'].replace('/', '-')
+
+
+def remove_reconciler():
+    service = reconciler_service()
+    service_file = '/etc/systemd/system/' + service + '.service'
+    if not os.path.exists(service_file):
+        return
+    host.service_stop(service)
+    host.service('disable', service)
+    os.remove(service_file)
+    check_call(['systemctl', 'daemon-reload'])
+
+
+def report_reconciler_state(uuids):
+    """Report the result of the last apply of the reconciler in the unit status.
+
+    Args:
+        uuids (iterable): uuids of the resource files of this unit
+    Returns:
+        error states of the uuids whose resources could not be applied
+    """
+    try:
+        with open(unitdata.kv().get('deployer_path') + '/reconciler.state') as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if state['ok']:
+        if unitdata.kv().get('error-states'):
+            status_set('active', 'Could not create requested resources, check the deployer log for more details.')
+        else:
+            status_set('active', 'Ready')
+        return {}
+    log('Reconciler could not apply all resources: ' + state['error'])
+    status_set('active', 'Reconciler could not apply all resources, check '
+                         'journalctl -u ' + reconciler_service() + ' for more details.')
+    # kubectl names the files it could not apply, fall back to all uuids
+    path = unitdata.kv().get('deployer_path') + '/resources/'
+    failed = {os.path.basename(file).rsplit('-', 1)[0]
+              for file in re.findall(re.escape(path) + r'[^"\s]+\.yaml', state['error'])}
+    return {uuid: {'error': 'Could not create requested resources.'} for uuid in failed or uuids}
+
+
+def publish_shard_members():
+    """Publish all deployer units as members of the hash ring, only the leader can do this."""
+    members = [hookenv.local_unit()]
+    for relation_id in hookenv.relation_ids('deployers'):
+        members.extend(hookenv.related_units(relation_id))
+    members = json.dumps(sorted(set(members)))
+    if leader_get('shard-members') != members:
+        log('Publishing deployer shard members: ' + members)
+        leader_set({'shard-members': members})
+
+
+def peer_shard_status():
+    """Return the status of the shards of the other deployer units.
+
+    Returns:
+        {
+            'uuid': {...},
+            ...
+        }
+    """
+    from charms.layer.statusencoder import decode_status
+    status = {}
+    for relation_id in hookenv.relation_ids('deployers'):
+        for unit in hookenv.related_units(relation_id):
+            shard_status = hookenv.relation_get('shard-status', unit=unit, rid=relation_id)
+            if shard_status:
+                status.update(decode_status(json.loads(shard_status)))
+    return status
+
+
+def shard(uuids):
+    """Return the uuids this unit is responsible for.
+    Uuids are spread over all deployer units via consistent hashing, so adding
+    or removing a unit only moves the uuids of that unit. Until the leader has
+    published the members, the leader is responsible for all uuids.
+
+    Args:
+        uuids (iterable): uuids of requesting juju units
+    Returns:
+        list
+    """
+    members = json.loads(leader_get('shard-members') or '[]')
+    if not members:
+        return list(uuids) if hookenv.is_leader() else []
+    ring = HashRing(members)
+    return [uuid for uuid in uuids if ring.owner(uuid) == hookenv.local_unit()]
+
+
 def clean_deployer_config(resources):
     """Remove all resource files from this deployer.
     
     Args:
         resources (list): name of resource folder
     """
+    import shutil
     if resources is None:
         return
     for resource in resources:
@@ -231,11 +560,170 @@ def clean_deployer_config(resources):
         os.mkdir(path)
 
 
+def prepare_resource(uuid, request, resource, resource_id, resource_dir=None, priority_class=None,
+                     image_digests=None):
+    """Return a PreparedResource for one resource of a request, or a
+    HeadlessService for a Service with external ips.
+
+    Args:
+        uuid (str): uuid of the juju unit requesting the resource
+        request (dict): request of the juju unit
+        resource (dict): resource manifest
+        resource_id (int): index of the resource in the request
+        resource_dir (str): dir to write the resource file to
+        priority_class (str): priority class to set on the pods of the resource
+        image_digests (dict): {image: digest} of images to pin
+    Returns:
+        PreparedResource | HeadlessService
+    """
+    prepared_request = {
+        'uuid': uuid,
+        'resource': resource,
+        'namespace': config.get('namespace').rstrip(),
+        'unique_id': resource_id,
+        'model_uuid': request['model_uuid'],
+        'juju_unit': request['juju_unit'],
+    }
+    if resource_dir:
+        prepared_request['resource_dir'] = resource_dir
+    if priority_class:
+        prepared_request['priority_class'] = priority_class
+    if image_digests:
+        prepared_request['image_digests'] = image_digests
+    if config.get('image-pull-policy'):
+        prepared_request['pull_policy'] = config.get('image-pull-policy')
+    if resource.get('kind') == 'Service' and deployer_annotation(resource, 'external-ips'):
+        return ResourceFactory.create_resource('headless-service', prepared_request)
+    return ResourceFactory.create_resource('preparedresource', prepared_request)
+
+
+def prepare_quota(uuid, request, resource_dir=None):
+    """Return an AppQuota for a request or None if the app has no quota.
+    The `app-quota` config is the default, the optional `quota` of the
+    request overrides it.
+
+    Args:
+        uuid (str): uuid of the juju unit requesting the resources
+        request (dict): request of the juju unit
+        resource_dir (str): dir to write the resource file to
+    Returns:
+        AppQuota | None
+    """
+    hard = dict(yaml_config('app-quota') or {})
+    if isinstance(request.get('quota'), dict):
+        hard.update(request['quota'])
+    if not hard:
+        return None
+    quota_request = {
+        'uuid': uuid,
+        'namespace': config.get('namespace').rstrip(),
+        'hard': hard,
+        'model_uuid': request['model_uuid'],
+        'juju_unit': request['juju_unit'],
+    }
+    if resource_dir:
+        quota_request['resource_dir'] = resource_dir
+    return ResourceFactory.create_resource('app-quota', quota_request)
+
+
+def request_images(request):
+    """Return all images used in a request."""
+    images = set()
+    for resource in request['requests']:
+        for container in containers(resource):
+            if container.get('image'):
+                images.add(container['image'])
+    return images
+
+
+def image_digests(uuid, request, update_cache=True):
+    """Return {image: digest} for all images of a request which use a tag.
+    Tags are resolved once, the digests are reused until the request changes.
+
+    Args:
+        uuid (str): uuid of the juju unit requesting the resources
+        request (dict): request of the juju unit
+        update_cache (bool): store newly resolved digests for later calls
+    Returns:
+        dict
+    """
+    if not config.get('pin-image-digests'):
+        return {}
+    from charms.layer.images import resolve_digest
+    cache = unitdata.kv().get('image-digests', {})
+    request_hash = hashlib.md5(json.dumps(request['requests'], sort_keys=True).encode('utf-8')).hexdigest()
+    if cache.get(uuid, {}).get('request') != request_hash:
+        digests = {}
+        for image in request_images(request):
+            if '@' in image:
+                continue
+            digest = resolve_digest(image)
+            if digest:
+                digests[image] = digest
+            else:
+                log('Could not resolve the digest of image ' + image)
+        if not update_cache:
+            return digests
+        cache[uuid] = {'request': request_hash, 'digests': digests}
+        unitdata.kv().set('image-digests', cache)
+    return cache[uuid]['digests']
+
+
+def forget_image_digests(requests):
+    cache = unitdata.kv().get('image-digests', {})
+    unitdata.kv().set('image-digests', {uuid: cache[uuid] for uuid in cache if uuid in requests})
+
+
+def prepull_images(requests, digests):
+    """Pull all images that were not requested before on every node, so
+    rollouts of the requested resources do not wait for the registry.
+
+    Args:
+        requests (dict): {uuid: request}
+        digests (dict): {uuid: {image: digest}}
+    """
+    images = set()
+    pull_secrets = set()
+    for uuid, request in requests.items():
+        for image in request_images(request):
+            digest = digests.get(uuid, {}).get(image)
+            images.add(image + '@' + digest if digest else image)
+        for resource in request['requests']:
+            for secret in (pod_spec(resource) or {}).get('imagePullSecrets') or []:
+                pull_secrets.add(secret['name'])
+    prepulled = unitdata.kv().get('prepulled-images', [])
+    new_images = sorted(images - set(prepulled))
+    if not new_images:
+        return
+    status_set('maintenance', 'Pre-pulling {} new images'.format(len(new_images)))
+    prepull = ResourceFactory.create_resource('image-prepull', {
+        'namespace': config.get('namespace').rstrip(),
+        'images': new_images,
+        'pull_secrets': sorted(pull_secrets),
+        'timeout': config.get('prepull-timeout'),
+    })
+    prepull.write_resource_file()
+    if prepull.create_resource():
+        # Only remember images still in use so the list does not keep growing
+        unitdata.kv().set('prepulled-images', sorted(images))
+    else:
+        log('Not all images could be pre-pulled before the timeout: ' + ', '.join(new_images))
+    prepull.delete_resource()
+
+
 def configure_namespace():
     namespace = ResourceFactory.create_resource('namespace', {'name': config.get('namespace', 'default').rstrip(),
                                                               'deployer': deployer})
     namespace.write_resource_file()
     namespace.create_resource()
+    # Default container limits, needed for pods without limits under a quota
+    limit_range = ResourceFactory.create_resource('limit-range',
+                                                  {'namespace': config.get('namespace', 'default').rstrip(),
+                                                   'limits': yaml_config('default-limits')})
+    if limit_range.request['limits']:
+        limit_range.write_resource_file()
+    else:
+        limit_range.delete_resource()
     # Check if config.namespace changed
     if config.changed('namespace') and config.previous('namespace'):
         # Remove all resources from previous namespace created by this deployer
@@ -245,6 +733,33 @@ def configure_namespace():
         prev_namespace.delete_namespace_resources()
 
 
+def yaml_config(key):
+    """Return the YAML mapping of a config option, empty if the option is not set
+    and None if the option is not a valid YAML mapping."""
+    import yaml
+    try:
+        value = yaml.safe_load(config.get(key) or '') or {}
+    except yaml.YAMLError as e:
+        log('Config option {} is not valid YAML: {}'.format(key, e))
+        return None
+    if not isinstance(value, dict):
+        log('Config option {} is not a YAML mapping'.format(key))
+        return None
+    return value
+
+
+def invalid_yaml_configs():
+    """Block the unit if a YAML config option is invalid.
+
+    Returns:
+        list of invalid config options
+    """
+    invalid = [key for key in yaml_config_options if yaml_config(key) is None]
+    if invalid:
+        status_set('blocked', 'Invalid YAML mapping in config: ' + ', '.join(invalid))
+    return invalid
+
+
 def check_predefined_resources():
     """Return `kubectl get` about resources in deployer_path/resources.
     
@@ -0,0 +1,67 @@
+import os
+import sys
+import json
+import subprocess
+
+
+CHARM_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Every hook imports the reactive module, keep that cheap
+IMPORT_BUDGET = 0.5
+# Only needed by a few handlers, imported there
+DEFERRED_MODULES = ['yaml', 'jujubigdata', 'tempfile', 'shutil', 'charms.layer.images']
+
+# Imports the reactive module in a fresh interpreter with stubs for the
+# juju libraries, which are only available on a deployed unit.
+IMPORT_SCRIPT = '''
+import os
+import sys
+import json
+import time
+import types
+
+charm_dir = sys.argv[1]
+os.environ['JUJU_UNIT_NAME'] = 'kubernetes-deployer/0'
+
+
+def decorator(*args, **kwargs):
+    return lambda f: f
+
+
+def stub(name, **attrs):
+    module = types.ModuleType(name)
+    module.__getattr__ = lambda attr: decorator
+    module.__dict__.update(attrs)
+    sys.modules[name] = module
+    return module
+
+
+for name in ['charmhelpers', 'charmhelpers.core', 'charmhelpers.core.hookenv', 'charmhelpers.core.unitdata',
+             'charmhelpers.core.host', 'charmhelpers.core.templating', 'charms.reactive',
+             'charms.reactive.relations', 'charms.leadership']:
+    stub(name)
+stub('charms', __path__=[os.path.join(charm_dir, 'lib', 'charms')])
+sys.modules['charmhelpers.core'].hookenv = sys.modules['charmhelpers.core.hookenv']
+sys.modules['charmhelpers.core'].unitdata = sys.modules['charmhelpers.core.unitdata']
+sys.modules['charmhelpers.core'].host = sys.modules['charmhelpers.core.host']
+sys.modules['charmhelpers.core.hookenv'].config = lambda: {}
+
+start = time.monotonic()
+with open(os.path.join(charm_dir, 'reactive', 'kubernetes-deployer.py')) as f:
+    exec(compile(f.read(), 'kubernetes-deployer.py', 'exec'), {'__name__': 'kubernetes_deployer'})
+print(json.dumps({'duration': time.monotonic() - start, 'modules': sorted(sys.modules)}))
+'''
+
+
+def import_reactive_module():
+    output = subprocess.check_output([sys.executable, '-c', IMPORT_SCRIPT, CHARM_DIR])
+    return json.loads(output.decode('utf-8'))
+
+
+def test_import_time():
+    assert import_reactive_module()['duration'] < IMPORT_BUDGET
+
+
+def test_deferred_imports():
+    modules = import_reactive_module()['modules']
+    for module in DEFERRED_MODULES:
+        assert module not in modules